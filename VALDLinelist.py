@@ -35,26 +35,203 @@ Functions:
 
 
 import os
+import re
+import mmap
 import time
+import functools
+import contextlib
 import gzip
+import shutil
+import subprocess
 import datetime
 import base64
-from selenium import webdriver
-from selenium.webdriver.common.keys import Keys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+import requests
+from requests.adapters import HTTPAdapter
 import pickle
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 
 
+__buffer_size = 262144  # 256 KB buffer used when unzipping VALD files
+__mass_pattern = re.compile(r"\([^)]*\)")  # atomic masses in parenthesis, e.g. "(56)"
+__max_workers = 8  # maximum number of VALD requests that are worked on at the same time
+__write_buffer_size = 1048576  # 1 MB buffer used when writing line lists
+__lines_per_write = 8192  # number of lines that are collected before being written out
+# SPECTRUM line formats; wavelength, species_code, mass_number (for isotope mode), e_low, e_high, loggf, followed by
+# the fudge_factor, transition, and source columns which are the same for every line
+__spectrum_constants = "{:<10}{:<4}{:<8}".format("1.000", "99", "VALD")
+__spectrum_format = "{:<12}{:<8}{:<12}{:<12}{:<12}" + __spectrum_constants
+__spectrum_isotope_format = "{:<12}{:<8}" + "{:<4}".format("0") + "{:<12}{:<12}{:<12}" + __spectrum_constants
+__ev_per_wavenumber = 1.23981e-4  # eV per cm**-1
+__data_break_pattern = re.compile(rb"\n[^']")  # the end of a line followed by a line that does not start with "'"
+
+
+class _VALDFormParser(HTMLParser):
+    """ Collects the forms and links on a VALD web page. Each form field remembers the table row and cell that it sits
+    in so that the Extract All form can be filled out by its layout, the same way a browser user would.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.forms, self.links = [], {}
+        self._form, self._tables = None, []
+        self._select, self._option, self._textarea, self._link = None, None, None, None
+
+    def _add_field(self, attrs, field_type, value, checked=False):
+        row, cell = self._tables[-1] if self._tables else (0, 0)
+        field = {"name": attrs.get("name"), "type": field_type, "value": value, "checked": checked, "row": row,
+                 "cell": cell}
+        if self._form is not None:
+            self._form["fields"].append(field)
+        return field
+
+    def _end_option(self):
+        # An option without a value attribute is submitted with its text, the same as in a browser
+        if self._option is not None and self._select is not None:
+            if self._select["value"] is None or self._option["selected"]:
+                self._select["value"] = self._option["value"] if self._option["value"] is not None else \
+                    " ".join(self._option["text"].split())
+        self._option = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "form":
+            self._form = {"action": attrs.get("action") or "", "method": (attrs.get("method") or "get").lower(),
+                          "fields": []}
+            self.forms.append(self._form)
+        elif tag == "table":
+            self._tables.append([0, 0])
+        elif tag == "tr" and self._tables:
+            self._tables[-1] = [self._tables[-1][0] + 1, 0]
+        elif tag == "td" and self._tables:
+            self._tables[-1][1] += 1
+        elif tag == "input":
+            self._add_field(attrs, (attrs.get("type") or "text").lower(), attrs.get("value") or "",
+                            "checked" in attrs)
+        elif tag == "select":
+            self._select = self._add_field(attrs, "select", None)
+        elif tag == "option" and self._select is not None:
+            self._end_option()
+            self._option = {"value": attrs.get("value"), "text": "", "selected": "selected" in attrs}
+        elif tag == "textarea":
+            self._textarea = self._add_field(attrs, "textarea", "")
+        elif tag == "a" and "href" in attrs:
+            self._link = [attrs["href"], ""]
+
+    def handle_endtag(self, tag):
+        if tag == "form":
+            self._form = None
+        elif tag == "table" and self._tables:
+            self._tables.pop()
+        elif tag == "option":
+            self._end_option()
+        elif tag == "select":
+            self._end_option()
+            self._select = None
+        elif tag == "textarea":
+            self._textarea = None
+        elif tag == "a" and self._link is not None:
+            self.links[self._link[1].strip()] = self._link[0]
+            self._link = None
+
+    def handle_data(self, data):
+        if self._option is not None:
+            self._option["text"] += data
+        if self._textarea is not None:
+            self._textarea["value"] += data
+        if self._link is not None:
+            self._link[1] += data
+
+
+def _vald_page(response):
+    """ Parses a VALD web page.
+
+    :param response: (requests.Response) The response holding the VALD web page.
+    :return: (_VALDFormParser) The parser holding the forms and links of the page.
+    """
+
+    response.raise_for_status()
+    page = _VALDFormParser()
+    page.feed(response.text)
+    page.close()
+    return page
+
+
+def _vald_find_field(page, match):
+    """ Finds the first form field on a VALD web page that satisfies the given condition.
+
+    :param page: (_VALDFormParser) The parsed VALD web page.
+    :param match: (function) Takes a field dictionary and returns True for the desired field.
+    :return: (tuple(dict, dict)) The form and the field.
+    """
+
+    for form in page.forms:
+        for field in form["fields"]:
+            if match(field):
+                return form, field
+    raise ValueError("Could not find the expected form on the VALD website.")
+
+
+def _vald_click(form, field):
+    """ Clicks on a radio button or a checkbox within a form.
+
+    :param form: (dict) The form that contains the field.
+    :param field: (dict) The radio button or checkbox.
+    """
+
+    if field["type"] == "radio":
+        for other in form["fields"]:
+            if other["type"] == "radio" and other["name"] == field["name"]:
+                other["checked"] = False
+        field["checked"] = True
+    elif field["type"] == "checkbox":
+        field["checked"] = not field["checked"]
+
+
+def _vald_submit(session, response, form, submit=None):
+    """ Submits a form the same way that a browser would.
+
+    :param session: (requests.Session) The session used to talk to the VALD website.
+    :param response: (requests.Response) The response holding the page that the form came from.
+    :param form: (dict) The form to be submitted.
+    :param submit: (dict) The submit button that was pressed; the first submit button of the form if None
+    (default is None).
+    :return: (requests.Response) The response to the submitted form.
+    """
+
+    if submit is None:
+        submit = next((field for field in form["fields"] if field["type"] in ("submit", "image")), None)
+    payload = []
+    for field in form["fields"]:
+        if not field["name"] or field["type"] in ("reset", "button", "file"):
+            continue
+        if field["type"] in ("submit", "image") and field is not submit:
+            continue
+        if field["type"] == "image":
+            # Browsers send the coordinates that were clicked on instead of the value of an image button
+            payload.extend(((field["name"] + ".x", "0"), (field["name"] + ".y", "0")))
+            continue
+        if field["type"] in ("radio", "checkbox") and not field["checked"]:
+            continue
+        payload.append((field["name"], field["value"] or ""))
+    url = urljoin(response.url, form["action"])
+    if form["method"] == "post":
+        return session.post(url, data=payload)
+    return session.get(url, params=payload)
+
+
 def VALDForm(wave_start, wave_end, extraction_format="long", data_retrieval="ftp", linelist_config="custom", comment="",
-             email="", web_driver="", server="uppsala", show_browser=False):
+             email="", server="uppsala", session=None):
     """ Fills out the Extract All form on the VALD website ("http://vald.astro.uu.se/"). The VALD website
     might not give the full wavelength range of data. For large wavelength ranges, one must fill out multiple forms or
     use VALDDownload.
 
-    This function requires the use of Selenium and a chrome driver
-    (https://sites.google.com/a/chromium.org/chromedriver/downloads).
+    The forms are submitted directly over HTTP with a requests session, no web browser is needed.
 
     :param wave_start: (float) The desired starting wavelength value in angstroms.
     :param wave_end: (float) The desired ending wavelength value in angstroms.
@@ -63,68 +240,55 @@ def VALDForm(wave_start, wave_end, extraction_format="long", data_retrieval="ftp
     :param linelist_config: (str) The desired line list configuration; Default or Custom (default is custom).
     :param comment: (str) An optional comment that can be added to the request (default is "").
     :param email: (str) Your registered VALD email address.
-    :param web_driver: (str) The path to your Chrome driver.
     :param server: (str) The desired server; moscow, montpellier, or uppsala (default is "uppsala").
-    :param show_browser: (bool) Opens up your web browser while running (default is False).
+    :param session: (requests.Session) An already open session to reuse; opens a new one if None (default is None).
     """
 
-    # Find the Chrome webdriver
-    if show_browser:
-        driver = webdriver.Chrome(web_driver)
-    else:
-        option = webdriver.ChromeOptions()
-        option.add_argument("headless")
-        driver = webdriver.Chrome(web_driver, options=option)
-
-    # Go to VALD Interface
-    driver.get("http://vald.astro.uu.se/")
-
-    # Choose the server
-    server = server.lower()
-    if isinstance(server, str) and (server == "montpellier" or server == "moscow"):
-        server_dict = {"moscow": "VALD3 Mirror Moscow", "montpellier": "VALD3 Mirror Montpellier"}
-        driver.find_element_by_link_text(server_dict[server]).click()
-
-    # Log in with a registered email address
-    login = driver.find_element_by_name("user")
-    login.send_keys(email)
-    login.send_keys(Keys.RETURN)
-
-    # Select the Extract All option and fill out the form
-    driver.find_element_by_xpath("//input[@value='Extract All']").send_keys(Keys.RETURN)
-    driver.find_element_by_xpath("//table/tbody/tr[2]/td[2]/input").send_keys(str(wave_start))
-    driver.find_element_by_xpath("//table/tbody/tr[3]/td[2]/input").send_keys(str(wave_end))
-    if extraction_format.lower() == "long":
-        driver.find_element_by_xpath("//table/tbody/tr[5]/td[2]/input").click()
-    if data_retrieval.lower() == "ftp":
-        driver.find_element_by_xpath("//table/tbody/tr[7]/td[2]/input").click()
-    if linelist_config.lower() == "custom":
-        driver.find_element_by_xpath("//table/tbody/tr[18]/td[2]/input").click()
-    if comment != "" and isinstance(comment, str):
-        driver.find_element_by_xpath("//table/tbody/tr[22]/td[2]/input").send_keys(comment)
-    driver.find_element_by_xpath("//table/tbody/tr[24]/td[1]/input").send_keys(Keys.RETURN)
-
-    # Quits the driver
-    driver.quit()
-
-
-def VALDEmail(VALDserver="uppsala", display_message=True):
-    """ Uses the Gmail API to grab the newest email from VALD and returns the message along with the received date.
-    This function requires a credentials.JSON file and a token.pickle file that gives this function permission
-    to view your Gmail account.
-
-    Used this link to start working with the Gmail API:
-    https://developers.google.com/gmail/api/quickstart/python
-
-    :param VALDserver: (str) The server that the email will be coming from; uppsala, montpellier, or moscow
-    (default is "uppsala").
-    :param display_message: (bool) Prints the email message to the console (default is True).
-    :return: (str/NoneType) The message from the VALD email. If no such email exists, returns None.
+    with requests.Session() if session is None else contextlib.nullcontext(session) as session:
+        # Go to VALD Interface
+        response = session.get("http://vald.astro.uu.se/")
+
+        # Choose the server
+        server = server.lower()
+        if isinstance(server, str) and (server == "montpellier" or server == "moscow"):
+            server_dict = {"moscow": "VALD3 Mirror Moscow", "montpellier": "VALD3 Mirror Montpellier"}
+            response = session.get(urljoin(response.url, _vald_page(response).links[server_dict[server]]))
+
+        # Log in with a registered email address
+        form, login = _vald_find_field(_vald_page(response), lambda field: field["name"] == "user")
+        login["value"] = email
+        response = _vald_submit(session, response, form)
+
+        # Select the Extract All option
+        form, extract_all = _vald_find_field(_vald_page(response), lambda field: field["value"] == "Extract All")
+        response = _vald_submit(session, response, form, submit=extract_all)
+
+        # Fill out the form; the fields are found by their (row, cell) position within the form's table
+        form, _ = _vald_find_field(_vald_page(response), lambda field: (field["row"], field["cell"]) == (2, 2))
+        position = {}
+        for field in form["fields"]:
+            position.setdefault((field["row"], field["cell"]), field)
+        position[(2, 2)]["value"] = str(wave_start)
+        position[(3, 2)]["value"] = str(wave_end)
+        if extraction_format.lower() == "long":
+            _vald_click(form, position[(5, 2)])
+        if data_retrieval.lower() == "ftp":
+            _vald_click(form, position[(7, 2)])
+        if linelist_config.lower() == "custom":
+            _vald_click(form, position[(18, 2)])
+        if comment != "" and isinstance(comment, str):
+            position[(22, 2)]["value"] = comment
+        _vald_submit(session, response, form, submit=position[(24, 1)]).raise_for_status()
+
+
+@functools.lru_cache(maxsize=1)
+def _get_gmail_service():
+    """ Connects to the Gmail API. The connection is cached so that the token is only read and the service is only
+    built once per session.
+
+    :return: (googleapiclient.discovery.Resource) The Gmail API service.
     """
 
-    server = {"uppsala": "vald@physics.uu.se", "montpellier": "vald@vald.lupm.univ-montp2.fr",
-              "moscow": "vald3@inasan.ru"}
-
     # Variable creds will store the user access token.
     # If no valid token found, we will create one.
     creds = None
@@ -149,15 +313,52 @@ def VALDEmail(VALDserver="uppsala", display_message=True):
             pickle.dump(creds, token)
 
     # Connect to the Gmail API
-    service = build('gmail', 'v1', credentials=creds)
+    return build('gmail', 'v1', credentials=creds)
+
 
-    # Request the newest VALD message and decode it
-    result = service.users().messages().list(userId='me', labelIds=['INBOX'], q=server[VALDserver.lower()]).execute()
-    message = result.get('messages', [])[0]
-    if not message:
+def VALDEmail(VALDserver="uppsala", display_message=True, service=None, after=None, exclude=None):
+    """ Uses the Gmail API to grab the newest email from VALD and returns the message along with the received date.
+    This function requires a credentials.JSON file and a token.pickle file that gives this function permission
+    to view your Gmail account.
+
+    Used this link to start working with the Gmail API:
+    https://developers.google.com/gmail/api/quickstart/python
+
+    :param VALDserver: (str) The server that the email will be coming from; uppsala, montpellier, or moscow
+    (default is "uppsala").
+    :param display_message: (bool) Prints the email message to the console (default is True).
+    :param service: (googleapiclient.discovery.Resource) An already connected Gmail API service; connects to the Gmail
+    API if None (default is None).
+    :param after: (datetime.datetime) Only look for emails received after this date; any date if None
+    (default is None).
+    :param exclude: (set) Gmail message ids of emails to skip. If given, the oldest email that is not skipped is
+    returned instead of the newest one, and its id is added to the set so that the same email is not handed out twice
+    (default is None).
+    :return: (str/NoneType) The message from the VALD email. If no such email exists, returns None.
+    """
+
+    server = {"uppsala": "vald@physics.uu.se", "montpellier": "vald@vald.lupm.univ-montp2.fr",
+              "moscow": "vald3@inasan.ru"}
+
+    if service is None:
+        service = _get_gmail_service()
+
+    # Request the newest VALD message and decode it; Gmail does the date filtering
+    query = "from:" + server[VALDserver.lower()]
+    if after is not None:
+        query += " after:" + str(int(after.timestamp()))
+    result = service.users().messages().list(userId='me', labelIds=['INBOX'], q=query,
+                                             maxResults=1 if exclude is None else 500).execute()
+    messages = result.get('messages', [])
+    if exclude is not None:
+        # Gmail lists the newest email first; emails are handed out in the order they were received
+        messages = [message for message in reversed(messages) if message['id'] not in exclude]
+    if not messages:
         return None
     else:
-        txt = service.users().messages().get(userId='me', id=message['id']).execute()
+        if exclude is not None:
+            exclude.add(messages[0]['id'])
+        txt = service.users().messages().get(userId='me', id=messages[0]['id']).execute()
         payload = txt['payload']
         date_line = payload['headers'][1]['value']
         date = date_line[date_line.index(';') + 1:].lstrip()
@@ -177,11 +378,11 @@ def VALDEmail(VALDserver="uppsala", display_message=True):
 
 
 def VALDDownload(output_folder, wave_start, wave_end, extraction_format="long", data_retrieval="ftp",
-                 linelist_config="custom", email="", server="uppsala", web_driver="", download_folder="", silent=False,
-                 show_browser=False):
+                 linelist_config="custom", email="", server="uppsala", silent=False):
     """ Fills out the Extract All form on the VALD website ("http://vald.astro.uu.se/") as many times as needed to
     extract the desired wavelength range, accesses your Gmail emails from VALD to click the download links, and saves
-    the un-zipped versions of the files to the desired output folder.
+    the un-zipped versions of the files to the desired output folder. After the first form, the rest of the wavelength
+    range is requested from VALD in chunks that are all filled out and downloaded at the same time.
 
     Used this link to start working with the Gmail API:
     https://developers.google.com/gmail/api/quickstart/python
@@ -194,95 +395,236 @@ def VALDDownload(output_folder, wave_start, wave_end, extraction_format="long",
     :param linelist_config: (str) The desired line list configuration; Default or Custom (default is custom).
     :param email: (str) Your registered VALD email address.
     :param server: (str) The desired server; moscow, montpellier, uppsala, or vienna (default is "uppsala").
-    :param web_driver: (str) The path to your Chrome driver.
-    :param download_folder: (str) The path to your download folder.
     :param silent: (bool) Will not print lines to the console (default is False).
-    :param show_browser: (bool) Opens up your web browser while running (default is False).
     """
 
-    month_dict = {"Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6, "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10,
-                  "Nov": 11, "Dec": 12}
-
-    last_wavelength, count = 0, 1
-    while last_wavelength < wave_end:
-
-        # Fills out the Extract All form on VALD website
-        VALDForm(wave_start, wave_end+5, extraction_format=extraction_format, data_retrieval=data_retrieval,
-                 linelist_config=linelist_config, comment="Range " + str(count), email=email, server=server,
-                 web_driver=web_driver, show_browser=show_browser)
-        start_date = datetime.datetime.now()
-
-        # Finds the VALD download link in my email and downloads the file
-        wait_time = 0
-        if not silent:
-            print("\n---------------------------------------------------------------------\n",
-                  "Waiting for an email(" + str(count) + ") from VALD...")
-        while True:
-            message = VALDEmail(server, display_message=False)
-            if message is not None:
-                date = message.split("\n")[0].split()
-                year, month, day = int(date[3]), month_dict[date[2]], int(date[1])
-                hour, minute, second = int(date[4][:2].lstrip("0")), int(date[4][3:5].lstrip("0")), int(date[4][6:8].lstrip("0"))
-                received_date = datetime.datetime(year, month, day, hour, minute, second)
-                if received_date > start_date:
-                    break
-            time.sleep(60)
-            wait_time += 60
-            if wait_time > 1800:
-                if not silent:
-                    print("\nEmail was not received in time.\nTry a different server.")
+    form_options = {"extraction_format": extraction_format, "data_retrieval": data_retrieval,
+                    "linelist_config": linelist_config, "email": email}
+    service, lock, claimed = _get_gmail_service(), threading.Lock(), set()
+
+    # One session is shared by every chunk and round; its connection pool matches the number of workers so that each
+    # worker keeps its own connection to VALD open
+    with requests.Session() as session:
+        adapter = HTTPAdapter(pool_connections=__max_workers, pool_maxsize=__max_workers)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        # VALD limits how much data it gives per request, so the range is requested in rounds. The first request
+        # shows how wide of a wavelength range VALD will give, then the rest of the range is requested in chunks of
+        # that width all at once. Anything that is still missing gets requested in the next round. Every request goes
+        # 5 angstroms past the range that it is meant to cover.
+        chunks, ranges, width, count = [(wave_start, wave_end + 5)], [], None, 1
+        while chunks:
+            # Each round logs in again with a clean session. Every chunk of the round looks for emails received after
+            # the round started, so any chunk can download any email of the round.
+            session.cookies.clear()
+            round_start = datetime.datetime.now()
+            with ThreadPoolExecutor(max_workers=min(len(chunks), __max_workers)) as executor:
+                futures = [executor.submit(_download_one_chunk, output_folder, start, end, count + i, session, service,
+                                           lock, claimed, round_start, server, silent, **form_options)
+                           for i, (start, end) in enumerate(chunks)]
+                output_names = [future.result() for future in as_completed(futures)]
+            count += len(chunks)
+            if None in output_names:
                 break
-            else:
+
+            # Finds the wavelength range that each downloaded file covers. VALD might have cut the file off, so it only
+            # covers up to its last wavelength; the 5 extra angstroms of each request make sure that this reaches the
+            # next request. A file only covers its whole requested range if it has no lines, or if it has no lines past
+            # the start of the request (those were already downloaded).
+            for output_name in output_names:
+                request_start, request_end, lines_selected = _vald_header(output_name)
+                if lines_selected == 0:
+                    os.remove(output_name)
+                    ranges.append((request_start, request_end))
+                    if width is None:
+                        width = 0
+                    continue
+                last_wavelength = _last_wavelength(output_name)
+                if last_wavelength is None:
+                    raise ValueError("Could not find the last wavelength value in " + output_name + ".")
+                if width is None:
+                    # The first request asks for the whole range, so it shows how wide of a range VALD gives
+                    width = last_wavelength - request_start
+                if last_wavelength <= request_start:
+                    ranges.append((request_start, request_end))
+                else:
+                    ranges.append((request_start, last_wavelength))
                 if not silent:
-                    print("Still waiting for email(" + str(count) + ")...")
-        if wait_time > 1800:
+                    print("Last wavelength value for file(" + os.path.basename(output_name) + "): " +
+                          str(last_wavelength))
+
+            chunks = []
+            for start, end in _vald_gaps(ranges, wave_start, wave_end):
+                while width > 0 and end - start > width:
+                    chunks.append((start, start + width + 5))
+                    start += width
+                chunks.append((start, end + 5))
+
+
+def _vald_gaps(ranges, wave_start, wave_end):
+    """ Finds the wavelength ranges that are not yet covered by the downloaded VALD files.
+
+    :param ranges: (list(tuple(float, float))) The starting and ending wavelength values covered by each downloaded
+    file.
+    :param wave_start: (float) The desired starting wavelength value in angstroms.
+    :param wave_end: (float) The desired ending wavelength value in angstroms.
+    :return: (list(tuple(float, float))) The starting and ending wavelength values of each gap.
+    """
+
+    gaps, covered = [], wave_start
+    for start, end in sorted(ranges):
+        # VALD writes the requested range with 5 decimals, so smaller differences are not gaps
+        if start - covered > 1e-5:
+            gaps.append((covered, start))
+        covered = max(covered, end)
+    if covered < wave_end:
+        gaps.append((covered, wave_end))
+    return gaps
+
+
+def _vald_header(file_name):
+    """ Reads the first line of a VALD line list, e.g. "   4000.00000,   4100.00000,   2000,   50000, Wavelength
+    region, lines selected, lines processed". The number of lines selected is only trusted to tell whether the file
+    has no lines; VALD might report more lines than it actually wrote to the file.
+
+    :param file_name: (str) The VALD line list.
+    :return: (tuple(float, float, int)) The starting and ending wavelength values that were requested and the number
+    of lines selected.
+    """
+
+    with open(file_name, "r") as f:
+        header = f.readline().split(",")
+    return float(header[0]), float(header[1]), int(header[2])
+
+
+def _download_one_chunk(output_folder, wave_start, wave_end, count, session, service, lock, claimed, after, server,
+                        silent, **form_options):
+    """ Fills out a single Extract All form, waits for the email from VALD, and downloads the un-zipped file. Used by
+    VALDDownload to download many wavelength ranges at once.
+
+    The email that is downloaded is the oldest VALD email received after the round started that has not been claimed
+    by another chunk, so it might belong to a different chunk that was requested at the same time. Every chunk of the
+    round sends one request, so every chunk ends up with exactly one email.
+
+    :param output_folder: (str) The desired output folder for the unzipped VALD file.
+    :param wave_start: (float) The desired starting wavelength value in angstroms.
+    :param wave_end: (float) The desired ending wavelength value in angstroms.
+    :param count: (int) The number of the chunk, used for the comment and the file name.
+    :param session: (requests.Session) The session used to talk to the VALD website.
+    :param service: (googleapiclient.discovery.Resource) The Gmail API service.
+    :param lock: (threading.Lock) Guards the Gmail API service, which is not thread-safe, and the claimed emails.
+    :param claimed: (set) Gmail message ids of the emails that have already been downloaded.
+    :param after: (datetime.datetime) When the round started; only emails received after this date are downloaded.
+    :param server: (str) The desired server; moscow, montpellier, or uppsala.
+    :param silent: (bool) Will not print lines to the console.
+    :param form_options: The remaining VALDForm keyword arguments.
+    :return: (str/NoneType) The name of the unzipped VALD file. If the email was not received in time, returns None.
+    """
+
+    # Fills out the Extract All form on VALD website
+    VALDForm(wave_start, wave_end, comment="Range " + str(count), server=server, session=session, **form_options)
+
+    # Finds the VALD download link in my email and downloads the file
+    # Polls Gmail with a backoff: starts at 5 seconds and grows to at most 60 seconds between checks
+    wait_time, delay = 0, 5
+    if not silent:
+        print("\n---------------------------------------------------------------------\n",
+              "Waiting for an email(" + str(count) + ") from VALD...")
+    while True:
+        with lock:
+            message = VALDEmail(server, display_message=False, service=service, after=after, exclude=claimed)
+        if message is not None:
             break
-        if not silent:
-            print("Found email(" + str(count) + ") from VALD: \n", message, "\n")
-        link = message[message.index("http"): message.index("gz")+2]
-        request_num = link.split(".")[4]
-        if show_browser:
-            driver = webdriver.Chrome(web_driver)
+        time.sleep(delay)
+        wait_time += delay
+        delay = min(delay * 1.5, 60)
+        if wait_time > 1800:
+            if not silent:
+                print("\nEmail was not received in time.\nTry a different server.")
+            return None
         else:
-            option = webdriver.ChromeOptions()
-            option.add_argument("headless")
-            driver = webdriver.Chrome(web_driver, options=option)
-        driver.get(link)
-
-        # Unzips the downloaded VALD file
-        file_not_downloaded = True
-        if not silent:
-            print("Waiting for VALD file(" + str(count) + ") to download...")
-        while file_not_downloaded:
-            # To make sure that the file is fully downloaded
-            time.sleep(5)
-            for file in os.listdir(download_folder):
-                if request_num in file and "crdownload" not in file:
-                    input_name = os.path.join(download_folder, file)
-                    output_name = os.path.join(output_folder, os.path.splitext(file)[0] + "_" + str(count) + ".lst")
-                    with gzip.open(input_name, mode="rt") as fin:
-                        out = fin.read()
-                        with open(output_name, "w") as fout:
-                            fout.write(out)
-                    os.remove(input_name)
-                    file_not_downloaded = False
-                    break
             if not silent:
-                print("Still waiting for file(" + str(count) + ")...")
-        if not silent:
-            print("VALD file(" + str(count) + ") downloaded.\n")
-
-        # Finds the last wavelength value
-        with open(output_name, "r") as f:
-            lines = f.readlines()
-            for line in reversed(lines):
-                if " References:" in line:
-                    last_wavelength = wave_start = float(lines[lines.index(line) - 5].split()[2][:-1])
-                    break
-        if not silent:
-            print("Last wavelength value for file(" + str(count) + "): " + str(last_wavelength))
-        count += 1
-        driver.quit()
+                print("Still waiting for email(" + str(count) + ")...")
+    if not silent:
+        print("Found email(" + str(count) + ") from VALD: \n", message, "\n")
+    link = message[message.index("http"): message.index("gz")+2]
+    output_name = os.path.join(output_folder, os.path.splitext(os.path.basename(link))[0] + "_" + str(count) + ".lst")
+
+    # Downloads the VALD file and unzips it while it streams in
+    if not silent:
+        print("Waiting for VALD file(" + str(count) + ") to download...")
+    with session.get(link, stream=True) as response:
+        response.raise_for_status()
+        _gunzip(response.raw, output_name)
+    if not silent:
+        print("VALD file(" + str(count) + ") downloaded.\n")
+    return output_name
+
+
+def _gunzip(fin, output_name):
+    """ Unzips a gzip stream into a file. If pigz is installed, the stream is piped into it so that the file is
+    unzipped by a separate process while it downloads; otherwise Python's gzip module is used.
+
+    :param fin: (file object) The gzip stream, e.g. the raw response of a download.
+    :param output_name: (str) The name of the unzipped file.
+    """
+
+    pigz = shutil.which("pigz")
+    with open(output_name, "wb", buffering=__buffer_size) as fout:
+        if pigz is None:
+            with gzip.open(fin, mode="rb") as gz:
+                shutil.copyfileobj(gz, fout, length=__buffer_size)
+        else:
+            process = subprocess.Popen([pigz, "-dc"], stdin=subprocess.PIPE, stdout=fout, bufsize=0)
+            try:
+                shutil.copyfileobj(fin, process.stdin, length=__buffer_size)
+            except BrokenPipeError:
+                pass  # pigz stopped early, e.g. on a corrupt file; its exit status is checked below
+            finally:
+                process.stdin.close()
+                process.wait()
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, [pigz, "-dc"])
+
+
+def _last_wavelength(file_name):
+    """ Finds the last wavelength value within a VALD line list. The file is memory mapped, so only the end of the
+    file is actually read.
+
+    :param file_name: (str) The VALD line list.
+    :return: (float/NoneType) The last wavelength value. If the line list has no lines, returns None.
+    """
+
+    with open(file_name, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            index = mm.rfind(b" References:")
+            if index == -1:
+                return None
+            # Walks back from the references line to the last data line, 5 lines above it
+            start = mm.rfind(b"\n", 0, index) + 1
+            for _ in range(5):
+                if start == 0:
+                    return None
+                start = mm.rfind(b"\n", 0, start - 1) + 1
+            end = mm.find(b"\n", start)
+            return float(mm[start:end if end != -1 else len(mm)].split()[2][:-1])
+
+
+def _strip_masses(chars):
+    """ Removes the atomic masses in parenthesis from an element symbol string, e.g. " (12)C(16)O" becomes "CO".
+    Anything before the first atomic mass is dropped as well.
+
+    :param chars: (str) The element symbol string at the end of a 4th element line.
+    :return: (str) The element symbol string without the atomic masses.
+    """
+
+    start = chars.find("(")
+    if start == -1:
+        return chars
+    return __mass_pattern.sub("", chars[start:])
 
 
 def VALDFormat(input_file, output_file, silent=True):
@@ -290,54 +632,70 @@ def VALDFormat(input_file, output_file, silent=True):
     with Turbospectrum's "vald3line-BPz-freeformat". Use VALDCombineFormat if you also want to combine VALD files.
 
     :param input_file: (str) The input file name.
-    :param output_file: (str) The output file name.
+    :param output_file: (str/file object) The output file name, which is appended to, or an already open output file.
     :param silent: (bool) Will not print lines to the console (default is True).
     """
 
-    stop_string = "* oscillator strengths"
+    if isinstance(output_file, str):
+        with open(output_file, "a", buffering=__write_buffer_size) as fout:
+            VALDFormat(input_file, fout, silent=silent)
+        return
+
+    # Lines are collected and written out in large blocks rather than one at a time
+    stop_string, block = "* oscillator strengths", []
     with open(input_file, "r") as fin:
-        with open(output_file, "a") as fout:
-            for line in fin:
-                if stop_string in line:
-                    break
-                elif line[0] == "'":
-                    if ":" in line:
-                        # Finds the element symbol string at the end of the 4th element line.
-                        chars = line[line.rfind(" "):-2]
-                        # Finds any atomic masses in parenthesis within the element symbol strings.
-                        r = [i for i in range(len(chars)) if chars[i] == ")"]
-                        l = [j for j in range(len(chars)) if chars[j] == "("]
-                        # Removes the atomic masses from the element symbol strings.
-                        if len(l) > 0:
-                            chars = "".join([chars[r[-1]+1:] if k == range(len(l))[-1] else chars[r[k]+1:l[k+1]]
-                                             for k in range(len(l))])
-                        file_line = "'_" + " " * 29 + chars + " " * 5 + "'\n"
-                    else:
-                        file_line = line
-                    if not silent:
-                        print(file_line)
-                    fout.write(file_line)
+        for line in fin:
+            # Data lines start with "'" and the stop string starts with "*", so only the first character is checked
+            first_char = line[0]
+            if first_char == "'":
+                if ":" in line:
+                    # Finds the element symbol string at the end of the 4th element line.
+                    file_line = "'_" + " " * 29 + _strip_masses(line[line.rfind(" "):-2]) + " " * 5 + "'\n"
+                else:
+                    file_line = line
+                if not silent:
+                    print(file_line)
+                block.append(file_line)
+                if len(block) == __lines_per_write:
+                    output_file.write("".join(block))
+                    block.clear()
+            elif first_char == "*" and line.startswith(stop_string):
+                break
+    output_file.write("".join(block))
 
 
 def VALDCombineNoFormat(input_folder, output_file, silent=True):
-    """ Appends multiple VALD line lists together while NOT updating the 4th element lines.
+    """ Appends multiple VALD line lists together while NOT updating the 4th element lines. The lines are copied
+    as raw bytes, so the line endings of the input files are kept.
 
     :param input_folder: (str) The input folder; Must only contain VALD line list files!
     :param output_file: (str) The desired output file name.
     :param silent: (bool) Will not print lines to the console (default is True).
     """
 
-    stop_string = "* oscillator strengths"
-    for input_file in [file for file in os.listdir(input_folder) if os.path.isfile(os.path.join(input_folder, file))]:
-        with open(input_folder + "\\" + input_file, "r") as fin:
-            with open(output_file, "a") as fout:
-                for line in fin:
-                    if stop_string in line:
-                        break
-                    elif line[0] == "'":
-                        fout.write(line)
+    # The files are copied as raw bytes; each stretch of consecutive data lines is written out in one go
+    stop_string = b"* oscillator strengths"
+    with open(output_file, "ab") as fout:
+        for input_file in [file for file in os.listdir(input_folder) if os.path.isfile(os.path.join(input_folder, file))]:
+            with open(input_folder + "\\" + input_file, "rb") as fin:
+                if os.fstat(fin.fileno()).st_size == 0:
+                    continue
+                with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                    # The data ends at the line that starts with the stop string
+                    if mm[:len(stop_string)] == stop_string:
+                        continue
+                    end = mm.find(b"\n" + stop_string) + 1 or len(mm)
+
+                    # Finds the start of each stretch of data lines (those starting with "'"); end if there are none
+                    start = 0 if mm[:1] == b"'" else mm.find(b"\n'", 0, end) + 1 or end
+                    while start < end:
+                        data_break = __data_break_pattern.search(mm, start, end)
+                        run_end = data_break.start() + 1 if data_break else end
+                        fout.write(view[start:run_end])
                         if not silent:
-                            print(line)
+                            for line in mm[start:run_end].decode().splitlines(keepends=True):
+                                print(line)
+                        start = mm.find(b"\n'", run_end, end) + 1 or end
 
 
 def VALDCombineFormat(input_folder, output_file, silent=True):
@@ -349,11 +707,9 @@ def VALDCombineFormat(input_folder, output_file, silent=True):
     :param silent: (bool) Will not print lines to the console (default is True).
     """
 
-    if os.path.exists(output_file):
-        os.remove(output_file)
-    
-    for input_file in [file for file in os.listdir(input_folder) if os.path.isfile(os.path.join(input_folder, file))]:
-        VALDFormat(input_folder + "\\" + input_file, output_file, silent=silent)
+    with open(output_file, "w", buffering=__write_buffer_size) as fout:
+        for input_file in [file for file in os.listdir(input_folder) if os.path.isfile(os.path.join(input_folder, file))]:
+            VALDFormat(input_folder + "\\" + input_file, fout, silent=silent)
 
 
 def VALDSplit(input_file, max_size=(100, "mb"), silent=True):
@@ -368,21 +724,25 @@ def VALDSplit(input_file, max_size=(100, "mb"), silent=True):
 
     byte_dict = {"b": 1, "kb": 1e3, "mb": 1e6, "gb": 1e9}
     max_size = max_size[0]*byte_dict[max_size[1].lower()]
+    # Streams through the line list, starting a new file once the current one is close to the maximum size
     with open(input_file, "r") as fin:
-        lines, file_num = fin.readlines(), 1
-        while lines:
-            with open(os.path.splitext(input_file)[0] + "_" + str(file_num) + ".cut", "w", encoding="utf-8") as fout:
-                length = 0
-                for index, line in enumerate(lines, 1):
-                    length += len(line) + 1  # number of characters per line including "\n"
-                    fout.write(line)
-                    if not silent:
-                        print(line.rstrip("\n"))
-                    if max_size - length < 500 and line[1] == "_":
-                        new_start = index
-                        break
-                lines = lines[new_start:]
-                file_num += 1
+        fout, length, file_num = None, 0, 1
+        try:
+            for line in fin:
+                if fout is None:
+                    fout = open(os.path.splitext(input_file)[0] + "_" + str(file_num) + ".cut", "w", encoding="utf-8",
+                                buffering=__write_buffer_size)
+                    length = 0
+                length += len(line) + 1  # number of characters per line including "\n"
+                fout.write(line)
+                if not silent:
+                    print(line.rstrip("\n"))
+                if max_size - length < 500 and line[1] == "_":
+                    fout.close()
+                    fout, file_num = None, file_num + 1
+        finally:
+            if fout is not None:
+                fout.close()
 
 
 def VALDToSpectrum(input_file, output_file, eV=True, isotope=False, silent=False):
@@ -418,38 +778,30 @@ def VALDToSpectrum(input_file, output_file, eV=True, isotope=False, silent=False
     mol_dict = {'MgH': '112.0', 'TiO': '822.0', 'C2': '606.0', 'H2': '101.0', 'CN': '607.0', 'SiO': '814.0',
                 'CH': '106.0', 'OH': '608.0', 'SiH': '114'}
 
-    with open(input_file, "r") as fin:
-        with open(output_file, "w") as fout:
-            for line in fin:
-                line = line.split(",")
-                if isinstance(line, list) and len(line) >= 13:
-                    symbol = line[0][1:line[0].index(" ")]
+    # The species code is found once for each species, e.g. "'Fe 1'", instead of once per line
+    codes = {}
+    line_format = __spectrum_isotope_format if isotope else __spectrum_format
+    with open(input_file, "r") as fin, open(output_file, "w", buffering=__write_buffer_size) as fout:
+        for line in fin:
+            line = line.split(",")
+            if len(line) >= 13:
+                species = line[0]
+                if species not in codes:
+                    symbol = species[1:species.index(" ")]
                     element = elem_dict.get(symbol)
                     if element is None:
-                        code = mol_dict.get(symbol)
+                        codes[species] = mol_dict.get(symbol)
                     else:
-                        code = element + ion_dict.get(line[0][line[0].index(" ")+1:-1])
+                        codes[species] = element + ion_dict.get(species[species.index(" ")+1:-1])
 
-                    wavelength = "{:<12}".format(line[1].strip())
-                    species_code = "{:<8}".format(code)
-                    if isotope:
-                        mass_number = "{:<4}".format("0")  # for isotope mode
-                    else:
-                        mass_number = ""
-                    if eV:
-                        e_low = "{:<12}".format(int(float(line[3].strip())/1.23981e-4))
-                        e_high = "{:<12}".format(int(float(line[5].strip())/1.23981e-4))
-                    else:
-                        e_low = "{:<12}".format(int(line[3].strip()))
-                        e_high = "{:<12}".format(int(line[5].strip()))
-                    loggf = "{:<12}".format(line[2])
-                    fudge = "{:<10}".format("1.000")
-                    transition = "{:<4}".format("99")
-                    source = "{:<8}".format("VALD")
-
-                    out = wavelength + species_code + mass_number + e_low + e_high + loggf + fudge + transition + source
-                    fout.write(out + "\n")
-                    if not silent:
-                        print(out)
-                elif line[0] == "*":
-                    break
+                if eV:
+                    e_low, e_high = int(float(line[3]) / __ev_per_wavenumber), int(float(line[5]) / __ev_per_wavenumber)
+                else:
+                    e_low, e_high = int(line[3]), int(line[5])
+
+                out = line_format.format(line[1].strip(), codes[species], e_low, e_high, line[2])
+                fout.write(out + "\n")
+                if not silent:
+                    print(out)
+            elif line[0] == "*":
+                break
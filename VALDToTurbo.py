@@ -7,7 +7,7 @@ Functions:
     Turbospectrum format.
 
     VALDToTurboAuto: Runs a folder full of VALD line lists through "vald3line-BPz-freeformat.exe" to reformat into
-    Turbospectrum format.
+    Turbospectrum format. The line lists are reformatted in parallel.
 
     TurboSort: Takes a folder full of Turbospectrum formatted line lists and combines the atomic data from the files.
 
@@ -17,10 +17,15 @@ Functions:
 
 
 import os
+import uuid
+import itertools
 import subprocess
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 
 __format_path = "/home/virtual/Turbospectrum2019-19.1.2/Utilities/vald3line-BPz-freeformat.exe"
+__write_buffer_size = 1048576  # 1 MB buffer used when writing line lists
 
 
 def VALDToTurbo(input_file, output_file):
@@ -30,7 +35,8 @@ def VALDToTurbo(input_file, output_file):
     :param output_file: (str) The reformatted line list.
     """
 
-    shellname = os.path.dirname(__format_path) + "/format_auto.sh"
+    # Unique shell script name so that parallel workers do not overwrite each other's script
+    shellname = os.path.dirname(__format_path) + "/format_auto_" + str(os.getpid()) + "_" + uuid.uuid4().hex + ".sh"
     file_string = "#!/bin/csh -f\n\n" + \
           str(__format_path) + " << EOF\n" + \
           input_file + "\n" + \
@@ -40,14 +46,22 @@ def VALDToTurbo(input_file, output_file):
     with open(shellname, "w") as f:
         f.write(file_string)
 
-    os.chdir(os.path.dirname(shellname))
-    subprocess.run(["csh", os.path.basename(shellname)])
-    os.system("rm " + shellname)
+    subprocess.run(["csh", os.path.basename(shellname)], cwd=os.path.dirname(shellname))
+    os.remove(shellname)
+
+
+def _vald_to_turbo_star(pair):
+    """ Unpacks an (input_file, output_file) pair for VALDToTurbo; used by VALDToTurboAuto's process pool.
+
+    :param pair: (tuple(str, str)) The line list to be reformatted and the reformatted line list.
+    """
+
+    VALDToTurbo(*pair)
 
 
 def VALDToTurboAuto(input_folder, output_folder):
     """ Runs a folder full of VALD line lists through "vald3line-BPz-freeformat.exe" to reformat into
-    Turbospectrum format.
+    Turbospectrum format. Each line list is reformatted in its own process (one worker per CPU).
 
     :param input_folder: (str) The folder containing the line lists to be reformatted.
     :param output_folder: (str) The folder where the reformatted line lists will go.
@@ -56,9 +70,12 @@ def VALDToTurboAuto(input_folder, output_folder):
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    for linelist in [file for file in os.listdir(input_folder) if os.path.isfile(os.path.join(input_folder, file))]:
-        outfile = os.path.join(output_folder, os.path.splitext(linelist)[0] + "_TS.lst")
-        VALDToTurbo(os.path.join(input_folder, linelist), outfile)
+    pairs = [(os.path.join(input_folder, linelist), os.path.join(output_folder, os.path.splitext(linelist)[0] + "_TS.lst"))
+             for linelist in os.listdir(input_folder) if os.path.isfile(os.path.join(input_folder, linelist))]
+
+    # Each line list is reformatted by its own "vald3line-BPz-freeformat.exe" process
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(_vald_to_turbo_star, pairs))
 
 
 def TurboSort(input_folder, output_file):
@@ -69,7 +86,8 @@ def TurboSort(input_folder, output_file):
     :param output_file: (str) The desired output file name.
     """
 
-    atom_dict = {}
+    # Each element keeps its first header line, its total number of lines, and the lines themselves
+    atom_dict = defaultdict(lambda: {"header": None, "count": 0, "lines": []})
     for linelist in os.listdir(input_folder):
         file_line = 1
         with open(os.path.join(input_folder, linelist), "r") as fin:
@@ -82,43 +100,38 @@ def TurboSort(input_folder, output_file):
                 end = start + atomic_lines
                 splice = lines[start: end]
                 file_line = end + 1
-                if atomic_sym in atom_dict.keys():
-                    atomic_lines_previous = int(atom_dict[atomic_sym][0].split()[4])
-                    atomic_lines += atomic_lines_previous
-                    start_line, end_line_previous = atom_dict[atomic_sym][0][:27], atom_dict[atomic_sym][0][27:]
-                    end_line_updated = end_line_previous.replace(str(atomic_lines_previous), str(atomic_lines))
-                    if len(end_line_updated) > 10:
-                        diff = len(end_line_updated) - 10
-                        end_line_updated = end_line_updated[diff:]
-                        atom_dict[atomic_sym][0] = start_line + end_line_updated
-                    elif len(end_line_updated) < 10:
-                        diff = 10 - len(end_line_updated)
-                        atom_dict[atomic_sym][0] = start_line + " "*diff + end_line_updated
-                    else:
-                        atom_dict[atomic_sym][0] = start_line + end_line_updated
-                    # Sorts each element by wavelength
-                    atom_dict[atomic_sym].extend(splice)
-                    temp = atom_dict[atomic_sym][2:]
-                    temp.sort()
-                    atom_dict[atomic_sym] = atom_dict[atomic_sym][:2]
-                    atom_dict[atomic_sym].extend(temp)
-                else:
-                    header = [header, atomic_sym]
-                    header.extend(splice)
-                    atom_dict[atomic_sym] = header
-
-    # Sorts each element block by atomic number
-    vals = list(atom_dict.values())
-    for val in vals:
-        "\n".join(val)
-    vals.sort()
-    lines = []
-    for val in vals:
-        lines.extend(val)
-
-    with open(output_file, "w") as fout:
-        for line in lines:
-            fout.write(line)
+                entry = atom_dict[atomic_sym]
+                if entry["header"] is None:
+                    entry["header"] = header
+                entry["count"] += atomic_lines
+                entry["lines"].extend(splice)
+
+    # Sorts each element by wavelength, once all of the files have been read
+    for entry in atom_dict.values():
+        entry["lines"].sort()
+
+    # Sorts each element block by its species code (atomic number), e.g. "'  26.001   '" --> 26.001
+    vals = sorted(((_turbo_header(entry), atomic_sym, entry["lines"]) for atomic_sym, entry in atom_dict.items()),
+                  key=lambda val: float(val[0].split("'")[1]))
+
+    # Writes every block in a single call without building one big list of all of the lines
+    with open(output_file, "w", buffering=__write_buffer_size) as fout:
+        fout.writelines(itertools.chain.from_iterable(itertools.chain((header, atomic_sym), lines)
+                                                      for header, atomic_sym, lines in vals))
+
+
+def _turbo_header(entry):
+    """ Builds the header line of an element block in a Turbospectrum formatted line list with the updated number
+    of lines.
+
+    :param entry: (dict) The element's first header line, its total number of lines, and its lines.
+    :return: (str) The header line.
+    """
+
+    if entry["count"] == int(entry["header"].split()[4]):
+        return entry["header"]
+    # The number of lines is right aligned in the last 10 characters (including the newline)
+    return entry["header"][:27] + "{:>9}\n".format(entry["count"])
 
 
 def VALDToSortedTurbo(input_folder, output_file):